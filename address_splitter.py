@@ -1,40 +1,415 @@
+import argparse
 import csv
-from PIL import ImageFont, ImageDraw, Image
+import hashlib
+import os
+import sqlite3
+from bisect import bisect_right
+from collections import deque
+from functools import lru_cache, partial
+from itertools import accumulate
+from multiprocessing import Pool
+import PIL
+from PIL import ImageFont
+
+# Delimiter separating the parts of an address
+ADDRESS_DELIMITER = ", "
+
+# Buffer size for reading and writing CSV files, and number of rows written per batch
+IO_BUFFER_SIZE = 1 << 20
+WRITE_BATCH_SIZE = 1000
+
+# Number of address parts sent to a worker process at a time when measuring in parallel
+MEASURE_CHUNK_SIZE = 10_000
+
+# Number of addresses looked up in the on-disk cache per query
+CACHE_QUERY_CHUNK_SIZE = 500
+
+# Maximum number of distinct addresses whose formatted result is kept in memory
+SPLIT_CACHE_MAX_SIZE = 500_000
+
+# Basic layout walks glyph advances and kerning with FreeType directly, skipping Raqm text shaping
+# Faster, but without shaping widths can differ from the default engine, so it is only used when asked for
+try:
+    _BASIC_LAYOUT = ImageFont.Layout.BASIC
+except AttributeError:  # Pillow < 9.1
+    _BASIC_LAYOUT = ImageFont.LAYOUT_BASIC
+
+# Directories scanned for installed fonts, in priority order
+# When a font name exists in several directories, the one listed first wins
+FONT_DIRECTORIES = [
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts"),
+    "C:/Windows/Fonts",
+    "/Library/Fonts",
+    "/System/Library/Fonts",
+    os.path.expanduser("~/Library/Fonts"),
+]
+
+# Function to build an index of installed fonts
+# Returns two dicts: lowercase file names to paths, and lowercase file names without extension to paths
+# The font directories are scanned once, on first use, each one fully before the next,
+# so the order of FONT_DIRECTORIES is the lookup order
+@lru_cache(maxsize=None)
+def font_index():
+    by_file_name = {}
+    by_stem = {}
+    for font_directory in FONT_DIRECTORIES:
+        pending = deque([font_directory])
+        while pending:
+            directory = pending.popleft()
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue  # Directory does not exist on this system
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.name.lower().endswith(('.ttf', '.ttc', '.otf')):
+                        file_name = entry.name.lower()
+                        by_file_name.setdefault(file_name, entry.path)
+                        by_stem.setdefault(os.path.splitext(file_name)[0], entry.path)
+    return by_file_name, by_stem
+
+# Function to find the file for a font name such as "arial.ttf" or "Arial"
+# A name with an extension only matches that exact file name; a name without one matches any font file
+# Paths and files in the current directory are used as given; unknown names are left for Pillow to resolve
+def resolve_font_path(font_name):
+    if os.path.dirname(font_name) or os.path.isfile(font_name):
+        return font_name
+    by_file_name, by_stem = font_index()
+    if os.path.splitext(font_name)[1]:
+        return by_file_name.get(font_name.lower(), font_name)
+    return by_stem.get(font_name.lower(), font_name)
+
+# Function to load a TrueType font from an already resolved path, with Pillow's default
+# layout engine unless basic_layout is set
+# Fonts are cached per (path, size, layout) so repeated loads skip parsing the font file
+@lru_cache(maxsize=None)
+def load_font_file(font_path, font_size, basic_layout=False):
+    layout_engine = _BASIC_LAYOUT if basic_layout else None
+    return ImageFont.truetype(font_path, font_size, layout_engine=layout_engine)
+
+# Function to load a TrueType font by name, looking it up among the installed fonts
+def load_font(font_name, font_size, basic_layout=False):
+    return load_font_file(resolve_font_path(font_name), font_size, basic_layout)
 
 # Function to calculate the width of the text in the specified font
+# Results are memoized per (text, font) since the same address parts repeat across rows
+@lru_cache(maxsize=200_000)
 def text_width(text, font):
-    # Create a new image with arbitrary size
-    image = Image.new('RGB', (1000, 1000))
-    # Initialize the Draw object
-    draw = ImageDraw.Draw(image)
-    # Return the width of the given text using the specified font
-    return draw.textlength(text, font=font)
+    # Return the width of the given text, measured directly by the font without a Draw object
+    return font.getlength(text)
+
+# Function to build a table of advance widths for every ASCII character in the font
+@lru_cache(maxsize=None)
+def ascii_advance_table(font):
+    return [font.getlength(chr(code)) for code in range(128)]
+
+# Function to approximate the width of the text by summing per-character advance widths
+# Exact for monospace fonts; ignores kerning, so it is close but not exact for proportional fonts
+def approximate_text_width(text, font):
+    try:
+        encoded = text.encode('ascii')
+    except UnicodeEncodeError:
+        # Non-ASCII text is measured properly
+        return font.getlength(text)
+    table = ascii_advance_table(font)
+    return sum(map(table.__getitem__, encoded))
+
+# Addresses with more parts than this are split greedily to bound the cost of optimal fitting
+OPTIMAL_FIT_MAX_PARTS = 30
+
+# Function to find line breaks greedily, putting as many parts as fit on each line
+# prefix[k] is the width of the first k parts, each followed by a delimiter
+def greedy_breaks(prefix, delimiter_width, max_width):
+    breaks = [0]  # Indices of the first part on each line, plus the number of parts
+    start = 0
+        
+    while start < len(prefix) - 1:
+        # Find the last part boundary at which the line still fits
+        end = bisect_right(prefix, prefix[start] + max_width + delimiter_width) - 1
+        # A part wider than max_width on its own still gets a line of its own
+        start = max(end, start + 1)
+        breaks.append(start)
+        
+    return breaks
+
+# Function to find line breaks minimizing the sum of squared unused widths (Knuth-Plass style)
+# Unlike greedy fitting, this avoids leaving a very short last line
+def optimal_breaks(prefix, delimiter_width, max_width):
+    part_count = len(prefix) - 1
+    cost = [0.0] + [float('inf')] * part_count  # Best total penalty for the first j parts
+    previous = [0] * (part_count + 1)  # Start of the last line in that best split
+        
+    for end in range(1, part_count + 1):
+        # Try every start for the line ending at this part, from the shortest line up
+        for start in range(end - 1, -1, -1):
+            width = prefix[end] - prefix[start] - delimiter_width
+            if width > max_width:
+                if start < end - 1:
+                    break  # Longer lines only get wider
+                penalty = 0.0  # A part wider than max_width on its own gets a line anyway
+            else:
+                penalty = (max_width - width) ** 2
+            if cost[start] + penalty < cost[end]:
+                cost[end] = cost[start] + penalty
+                previous[end] = start
+        
+    # Walk back from the last part to recover where each line starts
+    breaks = [part_count]
+    while breaks[-1] > 0:
+        breaks.append(previous[breaks[-1]])
+    breaks.reverse()
+        
+    return breaks
+
+# Function to find the line breaks for a sequence of part widths
+# Works on plain numbers only and returns the index of the first part on each line,
+# followed by the number of parts
+def line_breaks(part_widths, delimiter_width, max_width):
+    # prefix[k] is the width of the first k parts, each followed by a delimiter,
+    # so parts i to j-1 on one line are prefix[j] - prefix[i] - delimiter_width wide
+    prefix = [0.0]
+    prefix.extend(accumulate(width + delimiter_width for width in part_widths))
+        
+    # If the whole address fits on one line there is nothing to split
+    if prefix[-1] - delimiter_width <= max_width:
+        return [0, len(part_widths)]
+        
+    if len(part_widths) <= OPTIMAL_FIT_MAX_PARTS:
+        return optimal_breaks(prefix, delimiter_width, max_width)
+    return greedy_breaks(prefix, delimiter_width, max_width)
+
+# Function to find the lines of an already split address using precomputed part widths
+# Returns (start, end) part index pairs, one per line; never calls Pillow
+def line_spans(parts, widths, delimiter_width, max_width):
+    # A single part cannot be split
+    if len(parts) == 1:
+        return [(0, 1)]
+        
+    breaks = line_breaks([widths[part] for part in parts], delimiter_width, max_width)
+    return list(zip(breaks, breaks[1:]))
+
+# Function to measure an address and find its lines
+# Returns the parts of the address and the (start, end) part index pairs of each line
+def measure_line_spans(address, font, max_width):
+    # An address with a single part cannot be split, so it stays on one line without being measured
+    # If the whole address fits on one line, one measurement is enough
+    if ADDRESS_DELIMITER not in address or text_width(address, font) <= max_width:
+        return [address], [(0, 1)]
+        
+    # Split the address into parts using ", " as the delimiter
+    parts = address.split(ADDRESS_DELIMITER)
+    # Measure the delimiter and each distinct part once
+    delimiter_width = text_width(ADDRESS_DELIMITER, font)
+    widths = {part: text_width(part, font) for part in parts}
+        
+    return parts, line_spans(parts, widths, delimiter_width, max_width)
+
+# Function to join the parts of each line found by line_spans or measure_line_spans
+# Trailing delimiter characters are stripped, so an empty part never leaves a stray ", " at the end of a line
+def join_lines(parts, spans):
+    return [ADDRESS_DELIMITER.join(parts[start:end]).rstrip(ADDRESS_DELIMITER) for start, end in spans]
+
+# Function to split an already split address using precomputed part widths
+def split_address_line_precomputed(parts, widths, delimiter_width, max_width):
+    spans = line_spans(parts, widths, delimiter_width, max_width)
+    return join_lines(parts, spans)
+
+# Function to split an already split address using precomputed part widths,
+# returning the lines joined with new line characters
+def split_address_line_precomputed_str(parts, widths, delimiter_width, max_width):
+    spans = line_spans(parts, widths, delimiter_width, max_width)
+    return '\n'.join(join_lines(parts, spans))
 
 # Function to split address lines
 def split_address_line(address, font, max_width):
-    # Split the address into parts using ", " as the delimiter
-    parts = address.split(', ')
-    lines = []  # List to store splitted lines of the address
-    current_line = ""  # Variable to store the current line being processed
-    
-    # Iterate through each part of the address
-    for part in parts:
-        # Check if adding the current part exceeds the maximum width
-        if text_width(current_line + part, font) <= max_width:
-            current_line += part + ", "  # Add part to the current line
-        else:
-            # If the current line exceeds the width, add it to lines and start a new line
-            lines.append(current_line.rstrip(', '))
-            current_line = part + ", "
-    
-    # Add any remaining text in the current line to lines
-    if current_line:
-        lines.append(current_line.rstrip(', '))
-    
-    return lines
+    parts, spans = measure_line_spans(address, font, max_width)
+    return join_lines(parts, spans)
+
+# Function to split address lines, returning them joined with new line characters
+def split_address_line_str(address, font, max_width):
+    parts, spans = measure_line_spans(address, font, max_width)
+    return '\n'.join(join_lines(parts, spans))
+
+# Font and measuring mode used by worker processes, set once per process by init_worker
+_worker_font = None
+_worker_fast_ascii = False
+
+# Function to load the font in a worker process
+# Takes a path already resolved by the parent, so workers never scan the font directories
+def init_worker(font_path, font_size, fast_ascii, basic_layout):
+    global _worker_font, _worker_fast_ascii
+    _worker_font = load_font_file(font_path, font_size, basic_layout)
+    _worker_fast_ascii = fast_ascii
+
+# Function run by worker processes to measure a chunk of address parts
+def measure_parts(parts):
+    if _worker_fast_ascii:
+        return [approximate_text_width(part, _worker_font) for part in parts]
+    return [_worker_font.getlength(part) for part in parts]
+
+# Function to measure address parts across several processes
+# Returns a dict mapping each part to its width
+def measure_parts_parallel(parts, font_name, font_size, fast_ascii, basic_layout, workers):
+    parts = list(parts)
+    chunks = [parts[i:i + MEASURE_CHUNK_SIZE] for i in range(0, len(parts), MEASURE_CHUNK_SIZE)]
+    # Resolve the font once here rather than in every worker
+    font_path = resolve_font_path(font_name)
+    with Pool(workers, initializer=init_worker, initargs=(font_path, font_size, fast_ascii, basic_layout)) as pool:
+        # imap keeps the chunks in order, so widths line up with parts
+        widths = [width for chunk_widths in pool.imap(measure_parts, chunks) for width in chunk_widths]
+    return dict(zip(parts, widths))
+
+# Function to open the on-disk cache of formatted addresses
+# Each combination of settings that affects the result gets its own database file. The font is
+# identified by the file actually loaded, with its size and modification time, and measuring by the
+# layout engine actually in use and the Pillow version, so none of them changing reuses stale results
+def open_split_cache(cache_dir, font, max_width_px, fast_ascii):
+    font_path = os.path.abspath(font.path)
+    font_stat = os.stat(font_path)
+    settings = repr((font_path, font_stat.st_size, font_stat.st_mtime_ns, font.size,
+                     int(font.layout_engine), PIL.__version__,
+                     round(max_width_px), ADDRESS_DELIMITER, fast_ascii))
+    digest = hashlib.sha1(settings.encode('utf-8')).hexdigest()[:16]
+    os.makedirs(cache_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(cache_dir, f"address_splits_{digest}.sqlite"))
+    connection.execute("CREATE TABLE IF NOT EXISTS splits (address TEXT PRIMARY KEY, split TEXT NOT NULL)")
+    return connection
+
+# Function to look up formatted addresses in the on-disk cache
+# Returns a dict mapping each address found to its formatted form
+def load_cached_splits(connection, addresses):
+    addresses = list(addresses)
+    found = {}
+    for i in range(0, len(addresses), CACHE_QUERY_CHUNK_SIZE):
+        chunk = addresses[i:i + CACHE_QUERY_CHUNK_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        found.update(connection.execute(f"SELECT address, split FROM splits WHERE address IN ({placeholders})", chunk))
+    return found
+
+# Function to save newly formatted addresses to the on-disk cache in one transaction
+def store_splits(connection, splits):
+    with connection:
+        connection.executemany("INSERT OR REPLACE INTO splits (address, split) VALUES (?, ?)", splits.items())
+
+# Function to split the addresses in a CSV file and write the result to a new CSV file
+# The dialect is used for both files; callers that already detected it can pass it in
+# With a cache directory, formatted addresses are reused across runs
+def process_csv(csv_file_path, output_file_path, font_name, font_size, max_width_px, address_column_number,
+                fast_ascii=False, workers=1, dialect='excel', cache_dir=None, basic_layout=False):
+    font = load_font(font_name, font_size, basic_layout)
+        
+    # Connection to the on-disk cache, if one is used
+    connection = None
+    if cache_dir is not None:
+        connection = open_split_cache(cache_dir, font, max_width_px, fast_ascii)
+
+    try:
+        # Open the input CSV file for reading
+        with open(csv_file_path, mode='r', encoding='utf-8', buffering=IO_BUFFER_SIZE) as infile, \
+             open(output_file_path, mode='w', encoding='utf-8', newline='', buffering=IO_BUFFER_SIZE) as outfile:
+             
+            reader = csv.reader(infile, dialect)  # Initialize CSV reader
+            writer = csv.writer(outfile, dialect)  # Initialize CSV writer with the same dialect
+
+            # Read and write header row
+            headers = next(reader)
+            writer.writerow(headers)
+            
+            # Read the remaining rows so addresses can be measured in one batch before splitting
+            rows = list(reader)
+            
+            # Collect every distinct address part in the file and measure each one only once
+            # Only distinct addresses are split, so repeated addresses are not split again here
+            unique_addresses = {row[address_column_number] for row in rows if len(row) > address_column_number}
+            
+            # Addresses formatted by earlier runs need neither splitting nor measuring
+            stored_splits = {}
+            if connection is not None:
+                stored_splits = load_cached_splits(connection, unique_addresses)
+            
+            # Single-part addresses cannot be split, so they are never measured
+            unique_parts = set()
+            for address in unique_addresses:
+                if address not in stored_splits and ADDRESS_DELIMITER in address:
+                    unique_parts.update(address.split(ADDRESS_DELIMITER))
+            # Every part here is distinct, so measure directly rather than through the text_width cache
+            if fast_ascii:
+                measure = partial(approximate_text_width, font=font)
+            else:
+                measure = font.getlength
+            if workers > 1 and len(unique_parts) > MEASURE_CHUNK_SIZE:
+                # Large files are measured in several processes, each loading its own copy of the font
+                widths = measure_parts_parallel(unique_parts, font_name, font_size, fast_ascii, basic_layout, workers)
+            else:
+                widths = {part: measure(part) for part in unique_parts}
+            delimiter_width = measure(ADDRESS_DELIMITER)
+            
+            # Cache of already formatted addresses, since the same address often repeats across rows
+            split_cache = {}
+            
+            # Addresses formatted in this run, to be saved to the on-disk cache
+            new_splits = {}
+            
+            # Rows waiting to be written to the output file
+            batch = []
+            
+            # Process each row in the input CSV file
+            for row in rows:
+                if len(row) > address_column_number:
+                    # Retrieve the original address from the specified column
+                    original_address = row[address_column_number]
+                    
+                    modified_address = split_cache.get(original_address)
+                    if modified_address is None:
+                        modified_address = stored_splits.get(original_address)
+                        if modified_address is None:
+                            # Split the address into multiple lines within max width, joined with new line characters
+                            parts = original_address.split(ADDRESS_DELIMITER)
+                            modified_address = split_address_line_precomputed_str(parts, widths, delimiter_width, max_width_px)
+                            if connection is not None:
+                                new_splits[original_address] = modified_address
+                        
+                        # Remember the result, bounding the cache to keep memory in check
+                        if len(split_cache) < SPLIT_CACHE_MAX_SIZE:
+                            split_cache[original_address] = modified_address
+                    
+                    # Replace the original address with the modified address in the row
+                    row[address_column_number] = modified_address
+                
+                # Write the modified rows to the output CSV file in batches
+                batch.append(row)
+                if len(batch) >= WRITE_BATCH_SIZE:
+                    writer.writerows(batch)
+                    batch.clear()
+            
+            # Write any rows left in the last batch
+            writer.writerows(batch)
+        
+        # Save the newly formatted addresses for the next run
+        if connection is not None:
+            store_splits(connection, new_splits)
+    finally:
+        # Close the on-disk cache even if processing fails
+        if connection is not None:
+            connection.close()
 
 def main():
-    import os  # Import os module for file path operations
+    # Parse optional command line flags
+    parser = argparse.ArgumentParser(description="Split addresses in a CSV file into lines that fit a maximum width.")
+    parser.add_argument("--fast-ascii", action="store_true",
+                        help="approximate the width of ASCII text from per-character widths (ignores kerning)")
+    parser.add_argument("--basic-layout", action="store_true",
+                        help="measure text with Pillow's basic layout engine instead of Raqm (faster, no text shaping)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes used to measure address parts (default: 1)")
+    parser.add_argument("--cache-dir",
+                        help="directory for a cache of formatted addresses that is reused across runs")
+    args = parser.parse_args()
 
     # Prompt user for input
     csv_file_path = input("Enter the path to the CSV file: ")
@@ -46,40 +421,16 @@ def main():
     # 1 cm is approximately 37.8 pixels at 96 DPI
     max_width_px = int(max_length_cm * 37.8)
 
-    # Load the Arial font. Adjust the font path if necessary.
-    font = ImageFont.truetype("arial.ttf", font_size)
+    # Use the Arial font. Adjust the font path if necessary.
+    font_name = "arial.ttf"
 
     # Prepare the output file path by appending "_modified" to the original file name
     output_file_path = os.path.splitext(csv_file_path)[0] + "_modified.csv"
 
-    # Open the input CSV file for reading
-    with open(csv_file_path, mode='r', encoding='utf-8') as infile, \
-         open(output_file_path, mode='w', encoding='utf-8', newline='') as outfile:
-         
-        reader = csv.reader(infile)  # Initialize CSV reader
-        writer = csv.writer(outfile)  # Initialize CSV writer
-
-        # Read and write header row
-        headers = next(reader)
-        writer.writerow(headers)
-        
-        # Process each row in the input CSV file
-        for row in reader:
-            if len(row) > address_column_number:
-                # Retrieve the original address from the specified column
-                original_address = row[address_column_number]
-                
-                # Split the address into multiple lines within max width
-                split_lines = split_address_line(original_address, font, max_width_px)
-                
-                # Join the split lines with new line characters
-                modified_address = '\n'.join(split_lines)
-                
-                # Replace the original address with the modified address in the row
-                row[address_column_number] = modified_address
-            
-            # Write the modified row to the output CSV file
-            writer.writerow(row)
+    # Split the addresses and write them to the output file
+    process_csv(csv_file_path, output_file_path, font_name, font_size, max_width_px, address_column_number,
+                fast_ascii=args.fast_ascii, workers=args.workers, cache_dir=args.cache_dir,
+                basic_layout=args.basic_layout)
 
     # Print a message indicating the output file path
     print(f"Modified addresses saved to {output_file_path}")